@@ -1,8 +1,13 @@
+import contextlib
+import logging
+import sqlite3
 from pathlib import Path
 from typing import Any
 
 from flask import Flask
 
+logger = logging.getLogger(__name__)
+
 
 def create_app(test_config: Any = None):
     """Build a flask app for serving."""
@@ -25,4 +30,20 @@ def create_app(test_config: Any = None):
     # ensure the instance folder exists
     app_path.mkdir(exist_ok=True)
 
+    # add any missing indexes to the database and write any missing or outdated parquet
+    # cache files once, rather than on every request. This writes to the database file
+    # (see query_sqlite_db.create_indexes), so it can be turned off by setting
+    # PREPARE_DATABASE = False in the instance config, e.g. if the instance folder is read-only.
+    from nzgd_map import constants, query_sqlite_db
+
+    database_path = app_path / constants.database_file_name
+    if app.config.get("PREPARE_DATABASE", True) and database_path.exists():
+        try:
+            with contextlib.closing(sqlite3.connect(database_path)) as conn:
+                query_sqlite_db.build_parquet_cache(
+                    conn, app_path / constants.parquet_cache_dir_name
+                )
+        except (sqlite3.OperationalError, OSError):
+            logger.exception("Unable to prepare the database %s", database_path)
+
     return app
@@ -7,4 +7,63 @@ default_vs_to_vs30_correlation = "boore_2004"
 default_spt_to_vs_correlation = "brandenberg_2010"
 default_cpt_to_vs_correlation = "andrus_2007_pleistocene"
 database_file_name = "extracted_nzgd.db"
+parquet_cache_dir_name = "parquet_cache"
 source_files_base_url = "https://quakecoresoft.canterbury.ac.nz/nzgd_source_files/"
+
+# Columns of the Vs30 estimates used by the record templates (cpt_record.html and
+# spt_record.html), so only these are converted to dictionaries for Jinja
+record_details_common_columns = [
+    "record_name",
+    "latitude",
+    "longitude",
+    "investigation_date",
+    "published_date",
+    "region",
+    "district",
+    "city",
+    "suburb",
+    "estimate_number",
+    "vs30",
+    "vs30_stddev",
+    "vs30_log_residual",
+    "vs_to_vs30_correlation",
+]
+cpt_record_details_columns = record_details_common_columns + [
+    "deepest_depth",
+    "shallowest_depth",
+    "cpt_to_vs_correlation",
+]
+spt_record_details_columns = record_details_common_columns + [
+    "spt_to_vs_correlation",
+    "hammer_type",
+]
+
+# Column names that can be used in a query on the index page
+query_column_names = [
+    "cpt_id",
+    "nzgd_id",
+    "vs30",
+    "vs30_stddev",
+    "type_prefix",
+    "original_reference",
+    "investigation_date",
+    "published_date",
+    "latitude",
+    "longitude",
+    "model_vs30_foster_2019",
+    "model_vs30_stddev_foster_2019",
+    "model_gwl_westerhoff_2019",
+    "cpt_tip_net_area_ratio",
+    "measured_gwl",
+    "deepest_depth",
+    "shallowest_depth",
+    "region",
+    "district",
+    "suburb",
+    "city",
+    "record_name",
+    "vs30_log_residual",
+    "gwl_residual",
+    "spt_efficiency",
+    "spt_borehole_diameter",
+]
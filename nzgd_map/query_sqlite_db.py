@@ -3,12 +3,31 @@ This module provides a function to extract pre-computed Vs30 values for CPT and
 a SQLite database based on the selected correlations and hammer type.
 """
 
+import contextlib
+import functools
+import logging
+import os
 import sqlite3
+import threading
 import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas.api.types import union_categoricals
+
+logger = logging.getLogger(__name__)
+
+# Connections opened by get_conn, which are kept separately for each thread
+_thread_local = threading.local()
+
+# Threads used to extract the CPT and SPT data concurrently. The threads are reused between
+# requests, so they also reuse their database connections.
+_executor = ThreadPoolExecutor(max_workers=2)
 
 
 def clip_highest_and_lowest_percent(
@@ -52,84 +71,309 @@ def clip_highest_and_lowest_percent(
     return data
 
 
-def all_vs30s_given_correlations(
-    selected_vs30_correlation: str,
-    selected_cpt_to_vs_correlation: str,
-    selected_spt_to_vs_correlation: str,
-    selected_hammer_type: str,
+@contextlib.contextmanager
+def _debug_timer(message: str, *args: object) -> Iterator[None]:
+    """
+    Logs the time taken to run the body of a with statement, at debug level.
+
+    The time is only measured if debug logging is enabled.
+
+    Parameters
+    ----------
+    message : str
+        The log message, which can contain %-style placeholders for args. The time taken is appended.
+    *args : object
+        The arguments for the placeholders in message.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        yield
+        return
+    start_time = time.time()
+    yield
+    logger.debug(message + ": %.2f s", *args, time.time() - start_time)
+
+
+def _record_names(type_prefix: pd.Series, nzgd_id: pd.Series) -> pd.Series:
+    """
+    Builds the record names (e.g., CPT_123) from the type prefix and NZGD ID columns.
+
+    The strings are joined with a pyarrow compute kernel, which is about twice as fast as
+    concatenating the columns as Python string objects, and are kept in an Arrow buffer.
+
+    Parameters
+    ----------
+    type_prefix : pd.Series
+        The type prefix of each record (CPT, SCPT or BH), as strings or a categorical.
+    nzgd_id : pd.Series
+        The NZGD ID of each record.
+
+    Returns
+    -------
+    pd.Series
+        The record names, with the same index as type_prefix.
+    """
+    names = pc.binary_join_element_wise(
+        pc.cast(pa.array(type_prefix), pa.string()),
+        pc.cast(pa.array(nzgd_id), pa.string()),
+        "_",
+    )
+    return pd.Series(
+        pd.arrays.ArrowExtensionArray(names),
+        index=type_prefix.index,
+    )
+
+
+def _add_residual_columns(vs30s_df: pd.DataFrame) -> None:
+    """
+    Adds the vs30_log_residual and gwl_residual columns to a DataFrame of Vs30 values and metadata.
+
+    The residuals are computed into preallocated float arrays, so no intermediate arrays are
+    allocated. Missing values (nan or None) give a residual of nan.
+
+    Parameters
+    ----------
+    vs30s_df : pd.DataFrame
+        The Vs30 values and metadata, which is modified in place.
+    """
+    vs30_log_residual = np.empty(len(vs30s_df))
+    np.divide(
+        vs30s_df["vs30"].to_numpy(dtype=float, na_value=np.nan),
+        vs30s_df["model_vs30_foster_2019"].to_numpy(dtype=float, na_value=np.nan),
+        out=vs30_log_residual,
+    )
+    np.log(vs30_log_residual, out=vs30_log_residual)
+
+    gwl_residual = np.empty(len(vs30s_df))
+    np.subtract(
+        vs30s_df["measured_gwl"].to_numpy(dtype=float, na_value=np.nan),
+        vs30s_df["model_gwl_westerhoff_2019"].to_numpy(dtype=float, na_value=np.nan),
+        out=gwl_residual,
+    )
+
+    vs30s_df["vs30_log_residual"] = vs30_log_residual
+    vs30s_df["gwl_residual"] = gwl_residual
+
+
+def create_indexes(conn: sqlite3.Connection) -> None:
+    """
+    Creates the indexes used by the queries in this module, if they do not already exist.
+
+    The pre-computed Vs30 tables are filtered by correlation ids on every index page request,
+    which otherwise requires a full table scan. The CPT index also covers all the columns that
+    are selected from the table, so the table itself does not need to be read. The SPT
+    measurements index lets the depth range of each borehole be found from the index alone.
+    The remaining indexes are on the columns used to look up the data for a single record.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        The SQLite database connection.
+    """
+
+    indexes = {
+        "idx_cptvs30estimates_correlations": (
+            "cptvs30estimates(vs_to_vs30_correlation_id, cpt_to_vs_correlation_id, "
+            "cpt_id, nzgd_id, vs30, vs30_stddev)"
+        ),
+        "idx_sptvs30estimates_correlations": (
+            "sptvs30estimates(vs_to_vs30_correlation_id, spt_to_vs_correlation_id, "
+            "hammer_type_id)"
+        ),
+        "idx_sptmeasurements_borehole_depth": "sptmeasurements(borehole_id, depth)",
+        "idx_cptreport_nzgd_id": "cptreport(nzgd_id)",
+        "idx_cptmeasurements_cpt_id": "cptmeasurements(cpt_id)",
+        "idx_cptvs30estimates_nzgd_id": "cptvs30estimates(nzgd_id)",
+        "idx_sptvs30estimates_spt_id": "sptvs30estimates(spt_id)",
+        "idx_soilmeasurements_report_id": "soilmeasurements(report_id, top_depth)",
+        "idx_soilmeasurementsoiltype_soil_measurement_id": (
+            "soilmeasurementsoiltype(soil_measurement_id)"
+        ),
+    }
+
+    existing_indexes = {
+        row[0]
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    missing_indexes = [name for name in indexes if name not in existing_indexes]
+
+    for name in missing_indexes:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {indexes[name]}")
+
+    # Only update the query planner statistics when an index was added, as ANALYZE
+    # reads every table.
+    if missing_indexes:
+        conn.execute("ANALYZE")
+        conn.commit()
+
+
+def database_version(database_file: str | Path) -> tuple[int, int]:
+    """
+    Gets a key that changes whenever a SQLite database file is modified or replaced.
+
+    Parameters
+    ----------
+    database_file : str or Path
+        The path to the SQLite database file.
+
+    Returns
+    -------
+    tuple[int, int]
+        The inode number and modification time (in nanoseconds) of the database file.
+    """
+    stat_result = Path(database_file).stat()
+    return stat_result.st_ino, stat_result.st_mtime_ns
+
+
+def get_conn(database_file: str | Path) -> sqlite3.Connection:
+    """
+    Gets a long-lived connection to a SQLite database file for the current thread.
+
+    A connection is opened the first time each thread asks for one, as a SQLite connection cannot
+    be used by more than one thread. The connection is set up for reading: it is not allowed to
+    change the database, the database file is memory mapped, the page cache is enlarged, and
+    temporary tables and indices are kept in memory.
+
+    The connection is reopened if the database file has been modified or replaced since it was
+    opened, as a connection to a replaced file would keep reading the old file.
+
+    Parameters
+    ----------
+    database_file : str or Path
+        The path to the SQLite database file.
+
+    Returns
+    -------
+    sqlite3.Connection
+        The connection to the database.
+    """
+    if not hasattr(_thread_local, "connections"):
+        _thread_local.connections = {}
+
+    database_file = str(database_file)
+    version = database_version(database_file)
+    # The (database version, connection) opened for the database file
+    opened = _thread_local.connections.get(database_file)
+
+    if opened is None or opened[0] != version:
+        if opened is not None:
+            opened[1].close()
+        conn = sqlite3.connect(database_file)
+        conn.execute("PRAGMA query_only = 1")
+        conn.execute("PRAGMA mmap_size = 1073741824")  # 1 GiB
+        conn.execute("PRAGMA cache_size = -65536")  # 64 MiB
+        conn.execute("PRAGMA temp_store = MEMORY")
+        _thread_local.connections[database_file] = (version, conn)
+
+    return _thread_local.connections[database_file][1]
+
+
+def _database_file(conn: sqlite3.Connection) -> str:
+    """Get the path of the file of the main database of a SQLite connection."""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+@functools.lru_cache(maxsize=4)
+def _lookup_ids_for_database_file(
+    database_file: str, database_file_version: tuple[int, int]
+) -> dict[str, dict[str, int]]:
+    """
+    Reads the correlation and hammer type lookup tables from a SQLite database file.
+
+    Parameters
+    ----------
+    database_file : str
+        The path to the SQLite database file.
+    database_file_version : tuple[int, int]
+        The version of the database file from database_version. This is only used as part of the
+        cache key, so that the lookup tables are read again after the database has been modified or replaced.
+
+    Returns
+    -------
+    dict[str, dict[str, int]]
+        The name to id mapping of each lookup table.
+    """
+
+    # (table name, name of the id column) for each lookup table
+    lookup_tables = {
+        "vs_to_vs30_correlation": ("vstovs30correlation", "vs_to_vs30_correlation_id"),
+        "cpt_to_vs_correlation": ("cpttovscorrelation", "cpt_to_vs_correlation_id"),
+        "spt_to_vs_correlation": ("spttovscorrelation", "correlation_id"),
+        "hammer_type": ("spttovs30hammertype", "hammer_id"),
+    }
+
+    # The connection's context manager only commits, so it is closed explicitly
+    with contextlib.closing(sqlite3.connect(database_file)) as conn:
+        return {
+            key: dict(conn.execute(f"SELECT name, {id_column} FROM {table}").fetchall())
+            for key, (table, id_column) in lookup_tables.items()
+        }
+
+
+def correlation_and_hammer_type_ids(
     conn: sqlite3.Connection,
-) -> pd.DataFrame:
+) -> dict[str, dict[str, int]]:
     """
-    Extracts CPT and SPT data from the SQLite database based on the selected correlations and hammer type.
+    Gets the name to id mappings of the correlation and hammer type lookup tables.
+
+    The lookup tables are small, so they are only read once per version of the database
+    file and then served from memory.
 
     Parameters
     ----------
-    selected_vs30_correlation : str
-        The selected Vs to Vs30 correlation name.
-    selected_cpt_to_vs_correlation : str
-        The selected CPT to Vs correlation name.
-    selected_spt_to_vs_correlation : str
-        The selected SPT to Vs correlation name.
-    selected_hammer_type : str
-        The selected hammer type name.
     conn : sqlite3.Connection
         The SQLite database connection.
 
     Returns
     -------
-    pd.DataFrame
-        A DataFrame containing the extracted data.
+    dict[str, dict[str, int]]
+        A dictionary with keys "vs_to_vs30_correlation", "cpt_to_vs_correlation",
+        "spt_to_vs_correlation" and "hammer_type", where each value maps a name to its id.
     """
 
-    vs_to_vs30_correlation_df = pd.read_sql("SELECT * FROM vstovs30correlation", conn)
-    cpt_to_vs_correlation_df = pd.read_sql("SELECT * FROM cpttovscorrelation", conn)
-    spt_to_vs_correlation_df = pd.read_sql("SELECT * FROM spttovscorrelation", conn)
-    hammer_type_df = pd.read_sql("SELECT * FROM spttovs30hammertype", conn)
+    # The cache is keyed on the database file rather than the connection, as each
+    # thread has its own connection.
+    database_file = _database_file(conn)
+    return _lookup_ids_for_database_file(database_file, database_version(database_file))
 
-    vs_to_vs30_correlation_id_value = int(
-        vs_to_vs30_correlation_df[
-            vs_to_vs30_correlation_df["name"] == selected_vs30_correlation
-        ]["vs_to_vs30_correlation_id"].values[0]
-    )
-    cpt_to_vs_correlation_id_value = int(
-        cpt_to_vs_correlation_df[
-            cpt_to_vs_correlation_df["name"] == selected_cpt_to_vs_correlation
-        ]["cpt_to_vs_correlation_id"].values[0]
-    )
-    spt_to_vs_correlation_id_value = int(
-        spt_to_vs_correlation_df[
-            spt_to_vs_correlation_df["name"] == selected_spt_to_vs_correlation
-        ]["correlation_id"].values[0]
-    )
-    hammer_type_id_value = int(
-        hammer_type_df[hammer_type_df["name"] == selected_hammer_type][
-            "hammer_id"
-        ].values[0]
-    )
+
+def _cpt_vs30s_and_metadata(
+    vs_to_vs30_correlation_id: int,
+    cpt_to_vs_correlation_id: int,
+    conn: sqlite3.Connection,
+) -> pd.DataFrame:
+    """
+    Extracts CPT Vs30 values and metadata from the SQLite database for the given correlation ids.
+
+    Parameters
+    ----------
+    vs_to_vs30_correlation_id : int
+        The id of the Vs to Vs30 correlation.
+    cpt_to_vs_correlation_id : int
+        The id of the CPT to Vs correlation.
+    conn : sqlite3.Connection
+        The SQLite database connection.
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame containing the CPT Vs30 values and metadata.
+    """
 
     # The SQLite query to extract the pre-computed Vs30 values.
     # It takes too long to extract all pre-computed CPT Vs30s values from the SQLite database,
     # so we only extract the Vs30 values that were calculated with the selected Vs to Vs30 correlation
-    # (identified by vs_to_vs30_correlation_id_value) and the selected CPT to Vs correlation
-    # (identified by cpt_to_vs_correlation_id_value).
-    # We first filter on the Vs to Vs30 correlation, as there are only two, so this halves the number of rows
-    # to search through. We also only select certain columns as some like the vs30_id column are not needed, so only
-    # waste time if they are selected. We also filter using the integer id values, rather than the names as strings,
-    # to save time by avoiding SQLite JOIN operations with the tables that contain the string names of the correlations.
-    # In testing, this query takes about 0.4 seconds to run. If this is too slow, write the required
-    # data to a parquet file and read that instead, as reading from a parquet file was found to be 10x faster in testing.
-    cpt_sql_query = f"""
-    WITH filtered_data AS (
-        SELECT cpt_id, nzgd_id, cpt_to_vs_correlation_id, vs_to_vs30_correlation_id, vs30, vs30_stddev
-        FROM cptvs30estimates
-        WHERE vs_to_vs30_correlation_id = ?  -- First filter
-    ), second_filter AS (
-        SELECT cpt_id, nzgd_id, cpt_to_vs_correlation_id, vs_to_vs30_correlation_id, vs30, vs30_stddev
-        FROM filtered_data
-        WHERE cpt_to_vs_correlation_id = ?   -- Second filter
-    )
+    # (identified by vs_to_vs30_correlation_id) and the selected CPT to Vs correlation
+    # (identified by cpt_to_vs_correlation_id).
+    # Both correlation ids are filtered on in a single WHERE clause, so SQLite can find the rows with one search of
+    # the idx_cptvs30estimates_correlations index. We also only select certain columns as some like the vs30_id
+    # column are not needed, so only waste time if they are selected. We also filter using the integer id values,
+    # rather than the names as strings, to save time by avoiding SQLite JOIN operations with the tables that contain
+    # the string names of the correlations.
+    # In testing, this query takes about 0.4 seconds to run, so its result can be cached in a parquet file
+    # with build_parquet_cache, as reading from a parquet file was found to be 10x faster in testing.
+    cpt_sql_query = """
     SELECT 
-        sf.cpt_id, sf.nzgd_id, sf.vs30, sf.vs30_stddev,
+        ve.cpt_id, ve.nzgd_id, ve.vs30, ve.vs30_stddev,
         n.type_prefix, n.original_reference, n.investigation_date, n.published_date,
         n.latitude, n.longitude, n.model_vs30_foster_2019, n.model_vs30_stddev_foster_2019,
         n.model_gwl_westerhoff_2019, cr.tip_net_area_ratio, cr.measured_gwl,
@@ -138,9 +382,9 @@ def all_vs30s_given_correlations(
         d.name AS district_name,
         sub.name AS suburb_name,
         cty.name AS city_name
-    FROM second_filter AS sf
+    FROM cptvs30estimates AS ve
     JOIN nzgdrecord AS n
-        ON sf.nzgd_id = n.nzgd_id
+        ON ve.nzgd_id = n.nzgd_id
     JOIN region AS r
         ON n.region_id = r.region_id
     JOIN district AS d
@@ -150,62 +394,62 @@ def all_vs30s_given_correlations(
     JOIN city AS cty
         ON n.city_id = cty.city_id
     JOIN cptreport AS cr
-        ON sf.cpt_id = cr.cpt_id;
+        ON ve.cpt_id = cr.cpt_id
+    WHERE ve.vs_to_vs30_correlation_id = ?
+        AND ve.cpt_to_vs_correlation_id = ?;
     """
 
-    # Extract the CPT data from the SQLite database and store it in a Pandas DataFrame.
-    # Also get timing points (t1, t2) to assess performance.
-    t1 = time.time()
-    cpt_database_df = pd.read_sql(
+    return pd.read_sql(
         cpt_sql_query,
         conn,
-        params=(vs_to_vs30_correlation_id_value, cpt_to_vs_correlation_id_value),
+        params=(vs_to_vs30_correlation_id, cpt_to_vs_correlation_id),
     )
-    t2 = time.time()
 
-    # Add columns needed for the web app
-    cpt_database_df["record_name"] = (
-        cpt_database_df["type_prefix"].astype(str)
-        + "_"
-        + cpt_database_df["nzgd_id"].astype(str)
-    )
-    cpt_database_df["vs30_log_residual"] = np.log(cpt_database_df["vs30"]) - np.log(
-        cpt_database_df["model_vs30_foster_2019"]
-    )
-    cpt_database_df["gwl_residual"] = (
-        cpt_database_df["measured_gwl"] - cpt_database_df["model_gwl_westerhoff_2019"]
-    )
 
-    # The SQLite query to extract the SPT data.
+def _spt_vs30s_and_metadata(
+    vs_to_vs30_correlation_id: int,
+    spt_to_vs_correlation_id: int,
+    hammer_type_id: int,
+    conn: sqlite3.Connection,
+) -> pd.DataFrame:
+    """
+    Extracts SPT Vs30 values and metadata from the SQLite database for the given correlation and hammer type ids.
+
+    Parameters
+    ----------
+    vs_to_vs30_correlation_id : int
+        The id of the Vs to Vs30 correlation.
+    spt_to_vs_correlation_id : int
+        The id of the SPT to Vs correlation.
+    hammer_type_id : int
+        The id of the hammer type.
+    conn : sqlite3.Connection
+        The SQLite database connection.
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame containing the SPT Vs30 values and metadata.
+    """
+
+    # The SQLite query to extract the SPT data, including the shallowest and deepest depths of each borehole.
     # There far fewer SPT Vs30 values than CPT Vs30 values, so this should be fast, regardless of the query structure.
     spt_sql_query = """
-    WITH filtered_data AS (
-        SELECT *
-        FROM sptvs30estimates
-        WHERE vs_to_vs30_correlation_id = ?  -- First filter
-    ), second_filter AS (
-        SELECT *
-        FROM filtered_data
-        WHERE spt_to_vs_correlation_id = ?   -- Second filter
-    ), third_filter AS (
-        SELECT *
-        FROM second_filter
-        WHERE hammer_type_id = ?   -- Second filter
-    )
     SELECT 
-        tf.spt_id, tf.vs30, tf.vs30_stddev,
+        ve.spt_id, ve.vs30, ve.vs30_stddev,
         n.type_prefix, n.original_reference, n.investigation_date, n.published_date,
         n.latitude, n.longitude, n.model_vs30_foster_2019, n.model_vs30_stddev_foster_2019,
         n.model_gwl_westerhoff_2019, sr.measured_gwl, sr.efficiency, sr.borehole_diameter,
         r.name AS region_name,
         d.name AS district_name,
         sub.name AS suburb_name,
-        cty.name AS city_name
-    FROM third_filter AS tf
+        cty.name AS city_name,
+        dep.shallowest_depth, dep.deepest_depth
+    FROM sptvs30estimates AS ve
     JOIN nzgdrecord AS n
-        ON tf.spt_id = n.nzgd_id
+        ON ve.spt_id = n.nzgd_id
     JOIN sptreport AS sr
-        ON tf.spt_id = sr.borehole_id
+        ON ve.spt_id = sr.borehole_id
     JOIN region AS r
         ON n.region_id = r.region_id
     JOIN district AS d
@@ -213,63 +457,386 @@ def all_vs30s_given_correlations(
     JOIN suburb AS sub
         ON n.suburb_id = sub.suburb_id
     JOIN city AS cty
-        ON n.city_id = cty.city_id;
+        ON n.city_id = cty.city_id
+    LEFT JOIN (
+        SELECT borehole_id, MIN(depth) AS shallowest_depth, MAX(depth) AS deepest_depth
+        FROM sptmeasurements
+        GROUP BY borehole_id
+    ) AS dep
+        ON ve.spt_id = dep.borehole_id
+    WHERE ve.vs_to_vs30_correlation_id = ?
+        AND ve.spt_to_vs_correlation_id = ?
+        AND ve.hammer_type_id = ?;
     """
 
-    # Extract the SPT data from the SQLite database and store it in a Pandas DataFrame.
-    # Also get timing points (t3, t4) to assess performance.
-    t3 = time.time()
-    spt_partial_database_df = pd.read_sql(
+    return pd.read_sql(
         spt_sql_query,
         conn,
-        params=(
-            vs_to_vs30_correlation_id_value,
-            spt_to_vs_correlation_id_value,
-            hammer_type_id_value,
-        ),
+        params=(vs_to_vs30_correlation_id, spt_to_vs_correlation_id, hammer_type_id),
     )
-    t4 = time.time()
-
-    spt_measurements_df = pd.read_sql("SELECT * FROM sptmeasurements", conn)
-    # Use Pandas groupby to quickly calculate the shallowest and deepest depths for each borehole
-    depth_stats_df = (
-        spt_measurements_df.groupby("borehole_id")["depth"]
-        .agg(shallowest_depth="min", deepest_depth="max")
-        .reset_index()
+
+
+def _cpt_parquet_cache_file(
+    parquet_cache_dir: Path,
+    vs_to_vs30_correlation_id: int,
+    cpt_to_vs_correlation_id: int,
+) -> Path:
+    """Path of the parquet file caching the CPT Vs30s for the given correlation ids."""
+    return (
+        parquet_cache_dir
+        / f"cpt_{vs_to_vs30_correlation_id}_{cpt_to_vs_correlation_id}.parquet"
     )
 
-    spt_database_df = pd.merge(
-        spt_partial_database_df,
-        depth_stats_df,
-        left_on="spt_id",
-        right_on="borehole_id",
-        how="left",
+
+def _spt_parquet_cache_file(
+    parquet_cache_dir: Path,
+    vs_to_vs30_correlation_id: int,
+    spt_to_vs_correlation_id: int,
+    hammer_type_id: int,
+) -> Path:
+    """Path of the parquet file caching the SPT Vs30s for the given correlation and hammer type ids."""
+    return (
+        parquet_cache_dir
+        / f"spt_{vs_to_vs30_correlation_id}_{spt_to_vs_correlation_id}_{hammer_type_id}.parquet"
     )
-    spt_database_df.drop(columns="borehole_id", inplace=True)
 
-    # Rename and add columns needed for the web app
-    spt_database_df.rename(columns={"spt_id": "nzgd_id"}, inplace=True)
-    spt_database_df["record_name"] = (
-        spt_database_df["type_prefix"].astype(str)
-        + "_"
-        + spt_database_df["nzgd_id"].astype(str)
+
+def build_parquet_cache(conn: sqlite3.Connection, parquet_cache_dir: Path) -> None:
+    """
+    Writes the CPT and SPT Vs30s and metadata for every combination of correlations and hammer types
+    to parquet files, which all_vs30s_given_correlations reads instead of querying the SQLite database.
+
+    This should be run whenever the SQLite database is updated, as cached files that are older than
+    the database are ignored. Files that are newer than the database are kept, so only the missing or
+    outdated files are written. create_app runs this when the app starts, unless the app's
+    PREPARE_DATABASE config value is False.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        The SQLite database connection.
+    parquet_cache_dir : Path
+        The directory to write the parquet files to.
+    """
+
+    # Creating indexes modifies the database, so this must be done before writing the cache
+    # files for them to be newer than the database.
+    create_indexes(conn)
+
+    database_file = _database_file(conn)
+    parquet_cache_dir.mkdir(parents=True, exist_ok=True)
+    lookup_ids = correlation_and_hammer_type_ids(conn)
+
+    for vs_to_vs30_correlation_id in lookup_ids["vs_to_vs30_correlation"].values():
+        for cpt_to_vs_correlation_id in lookup_ids["cpt_to_vs_correlation"].values():
+            cache_file = _cpt_parquet_cache_file(
+                parquet_cache_dir,
+                vs_to_vs30_correlation_id,
+                cpt_to_vs_correlation_id,
+            )
+            if not _is_valid_cache_file(cache_file, database_file):
+                _write_parquet_cache_file(
+                    _cpt_vs30s_and_metadata(
+                        vs_to_vs30_correlation_id, cpt_to_vs_correlation_id, conn
+                    ),
+                    cache_file,
+                )
+
+        for spt_to_vs_correlation_id in lookup_ids["spt_to_vs_correlation"].values():
+            for hammer_type_id in lookup_ids["hammer_type"].values():
+                cache_file = _spt_parquet_cache_file(
+                    parquet_cache_dir,
+                    vs_to_vs30_correlation_id,
+                    spt_to_vs_correlation_id,
+                    hammer_type_id,
+                )
+                if not _is_valid_cache_file(cache_file, database_file):
+                    _write_parquet_cache_file(
+                        _spt_vs30s_and_metadata(
+                            vs_to_vs30_correlation_id,
+                            spt_to_vs_correlation_id,
+                            hammer_type_id,
+                            conn,
+                        ),
+                        cache_file,
+                    )
+
+
+def _write_parquet_cache_file(vs30s_df: pd.DataFrame, cache_file: Path) -> None:
+    """
+    Writes a parquet cache file for build_parquet_cache.
+
+    The file is written to a temporary file in the same directory, which is then renamed into
+    place. Since the rename is atomic, an app reading the cache while it is being rebuilt
+    sees either the old file or the complete new file, never a partly written one.
+
+    Parameters
+    ----------
+    vs30s_df : pd.DataFrame
+        The Vs30 values and metadata to write.
+    cache_file : Path
+        The path of the parquet cache file.
+    """
+    # The process id keeps the temporary files of apps that rebuild the cache at the same time apart
+    temporary_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        vs30s_df.to_parquet(
+            temporary_file,
+            engine="pyarrow",
+            compression="zstd",
+            row_group_size=50_000,
+            index=False,
+        )
+        os.replace(temporary_file, cache_file)
+    finally:
+        temporary_file.unlink(missing_ok=True)
+
+
+def _is_valid_cache_file(cache_file: Path | None, database_file: str) -> bool:
+    """Check that a parquet cache file exists and was written after the database was last modified."""
+    return (
+        cache_file is not None
+        and cache_file.exists()
+        and cache_file.stat().st_mtime >= Path(database_file).stat().st_mtime
     )
-    spt_database_df["vs30_log_residual"] = np.log(spt_database_df["vs30"]) - np.log(
-        spt_database_df["model_vs30_foster_2019"]
+
+
+def _read_vs30s_and_metadata(
+    record_type: str,
+    cache_file: Path | None,
+    database_file: str,
+    extract_from_database: Callable[..., pd.DataFrame],
+    *correlation_and_hammer_type_id_values: int,
+) -> pd.DataFrame:
+    """
+    Reads Vs30 values and metadata from a parquet cache file if it is valid, or otherwise from the database.
+
+    The database is read with the connection for the current thread, so that this function can be
+    run in its own thread.
+
+    Parameters
+    ----------
+    record_type : str
+        The type of record (CPT or SPT), used in the timing log message.
+    cache_file : Path, optional
+        The parquet cache file for the selected correlations (and hammer type).
+    database_file : str
+        The path to the SQLite database file.
+    extract_from_database : Callable[..., pd.DataFrame]
+        The function used to extract the data from the database (_cpt_vs30s_and_metadata or
+        _spt_vs30s_and_metadata).
+    *correlation_and_hammer_type_id_values : int
+        The id values passed to extract_from_database, before the database connection.
+
+    Returns
+    -------
+    pd.DataFrame
+        The Vs30 values and metadata.
+    """
+    if _is_valid_cache_file(cache_file, database_file):
+        with _debug_timer(
+            "Time to extract %s Vs30s and metadata from parquet cache", record_type
+        ):
+            # The cache files are immutable once written, so they are memory mapped rather than
+            # read into a separate buffer
+            return pd.read_parquet(cache_file, engine="pyarrow", memory_map=True)
+
+    with _debug_timer("Time to extract %s Vs30s and metadata from SQLite", record_type):
+        return extract_from_database(
+            *correlation_and_hammer_type_id_values, get_conn(database_file)
+        )
+
+
+def all_vs30s_given_correlations(
+    selected_vs30_correlation: str,
+    selected_cpt_to_vs_correlation: str,
+    selected_spt_to_vs_correlation: str,
+    selected_hammer_type: str,
+    conn: sqlite3.Connection,
+    parquet_cache_dir: Path | None = None,
+) -> pd.DataFrame:
+    """
+    Extracts CPT and SPT data from the SQLite database based on the selected correlations and hammer type.
+
+    Parameters
+    ----------
+    selected_vs30_correlation : str
+        The selected Vs to Vs30 correlation name.
+    selected_cpt_to_vs_correlation : str
+        The selected CPT to Vs correlation name.
+    selected_spt_to_vs_correlation : str
+        The selected SPT to Vs correlation name.
+    selected_hammer_type : str
+        The selected hammer type name.
+    conn : sqlite3.Connection
+        The SQLite database connection.
+    parquet_cache_dir : Path, optional
+        The directory containing parquet files written by build_parquet_cache. If given, and the required
+        files exist and are newer than the database, they are read instead of querying the database.
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame containing the extracted data.
+
+    Notes
+    -----
+    The most recently used results are cached in memory, and are extracted again if the database
+    file is modified or replaced. A copy of the cached result is returned, so it can be modified by the caller.
+    """
+
+    database_file = _database_file(conn)
+
+    return _vs30s_given_correlations(
+        database_file,
+        database_version(database_file),
+        selected_vs30_correlation,
+        selected_cpt_to_vs_correlation,
+        selected_spt_to_vs_correlation,
+        selected_hammer_type,
+        parquet_cache_dir,
+    ).copy()
+
+
+@functools.lru_cache(maxsize=4)
+def _vs30s_given_correlations(
+    database_file: str,
+    database_file_version: tuple[int, int],
+    selected_vs30_correlation: str,
+    selected_cpt_to_vs_correlation: str,
+    selected_spt_to_vs_correlation: str,
+    selected_hammer_type: str,
+    parquet_cache_dir: Path | None,
+) -> pd.DataFrame:
+    """
+    Extracts CPT and SPT data for all_vs30s_given_correlations, which caches the result.
+
+    Parameters
+    ----------
+    database_file : str
+        The path to the SQLite database file.
+    database_file_version : tuple[int, int]
+        The version of the database file from database_version. This is only used as part of the
+        cache key, so that the cached data is not used after the database has been modified or replaced.
+    selected_vs30_correlation : str
+        The selected Vs to Vs30 correlation name.
+    selected_cpt_to_vs_correlation : str
+        The selected CPT to Vs correlation name.
+    selected_spt_to_vs_correlation : str
+        The selected SPT to Vs correlation name.
+    selected_hammer_type : str
+        The selected hammer type name.
+    parquet_cache_dir : Path, optional
+        The directory containing parquet files written by build_parquet_cache.
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame containing the extracted data.
+    """
+
+    lookup_ids = _lookup_ids_for_database_file(database_file, database_file_version)
+
+    vs_to_vs30_correlation_id_value = lookup_ids["vs_to_vs30_correlation"][
+        selected_vs30_correlation
+    ]
+    cpt_to_vs_correlation_id_value = lookup_ids["cpt_to_vs_correlation"][
+        selected_cpt_to_vs_correlation
+    ]
+    spt_to_vs_correlation_id_value = lookup_ids["spt_to_vs_correlation"][
+        selected_spt_to_vs_correlation
+    ]
+    hammer_type_id_value = lookup_ids["hammer_type"][selected_hammer_type]
+
+    cpt_cache_file = spt_cache_file = None
+    if parquet_cache_dir is not None:
+        cpt_cache_file = _cpt_parquet_cache_file(
+            parquet_cache_dir,
+            vs_to_vs30_correlation_id_value,
+            cpt_to_vs_correlation_id_value,
+        )
+        spt_cache_file = _spt_parquet_cache_file(
+            parquet_cache_dir,
+            vs_to_vs30_correlation_id_value,
+            spt_to_vs_correlation_id_value,
+            hammer_type_id_value,
+        )
+
+    # The CPT and SPT data are independent, so extract them concurrently. Each thread uses its own
+    # connection to the database, as a SQLite connection cannot be used by more than one thread.
+    cpt_future = _executor.submit(
+        _read_vs30s_and_metadata,
+        "CPT",
+        cpt_cache_file,
+        database_file,
+        _cpt_vs30s_and_metadata,
+        vs_to_vs30_correlation_id_value,
+        cpt_to_vs_correlation_id_value,
     )
-    spt_database_df["gwl_residual"] = (
-        spt_database_df["measured_gwl"] - spt_database_df["model_gwl_westerhoff_2019"]
+    spt_future = _executor.submit(
+        _read_vs30s_and_metadata,
+        "SPT",
+        spt_cache_file,
+        database_file,
+        _spt_vs30s_and_metadata,
+        vs_to_vs30_correlation_id_value,
+        spt_to_vs_correlation_id_value,
+        hammer_type_id_value,
     )
+    cpt_database_df = cpt_future.result()
+    spt_database_df = spt_future.result()
+
+    spt_database_df.rename(columns={"spt_id": "nzgd_id"}, inplace=True)
+
+    # Store the low-cardinality string columns as categoricals with the same categories in both
+    # dataframes, so they stay categorical (and much smaller than object columns) after concatenation.
+    # The categories are sorted and ordered, so that comparisons such as region > "Canterbury" in a
+    # user's query compare the strings lexicographically, as they would for object columns.
+    for df in [cpt_database_df, spt_database_df]:
+        df["type_prefix"] = pd.Categorical(
+            df["type_prefix"], categories=["BH", "CPT", "SCPT"], ordered=True
+        )
+    for column in [
+        "region_name",
+        "district_name",
+        "suburb_name",
+        "city_name",
+    ]:
+        categories = union_categoricals(
+            [
+                pd.Categorical(cpt_database_df[column]),
+                pd.Categorical(spt_database_df[column]),
+            ]
+        ).categories.sort_values()
+        cpt_database_df[column] = pd.Categorical(
+            cpt_database_df[column], categories=categories, ordered=True
+        )
+        spt_database_df[column] = pd.Categorical(
+            spt_database_df[column], categories=categories, ordered=True
+        )
 
-    print(f"Time to extract CPT Vs30s and metadata from SQLite: {t2 - t1:.2f} s")
-    print(f"Time to extract SPT Vs30s and metadata from SQLite: {t4 - t3:.2f} s")
+    # Keep the remaining string columns in Arrow buffers rather than as Python string objects.
+    # Numeric columns are left as NumPy arrays, as the web app replaces some of their values
+    # with explanatory strings.
+    for df in [cpt_database_df, spt_database_df]:
+        for column in ["original_reference", "investigation_date", "published_date"]:
+            df[column] = df[column].astype(pd.ArrowDtype(pa.string()))
 
     # Concatenate the CPT and SPT dataframes so they can both be queried with a single Pandas query.
     # Columns that are only relevant for CPTs will be NaN for rows for SPTs (and vice versa).
     database_df = pd.concat([cpt_database_df, spt_database_df], ignore_index=True)
-    database_df["type_number_code"] = database_df["type_prefix"].map(
-        {"CPT": 0, "SCPT": 1, "BH": 2}
+    # Map the type prefix codes (0 for BH, 1 for CPT and 2 for SCPT) to type_number_code
+    # (0 for CPT, 1 for SCPT and 2 for BH)
+    database_df["type_number_code"] = np.array([2, 0, 1], dtype=np.int8)[
+        database_df["type_prefix"].cat.codes.to_numpy()
+    ]
+
+    # Add columns needed for the web app. These are added after concatenation so they are only
+    # computed once for all the records.
+    database_df["record_name"] = _record_names(
+        database_df["type_prefix"], database_df["nzgd_id"]
     )
+    _add_residual_columns(database_df)
 
     # rename the columns to match the web app and add prefixes of cpt spt to columns that only
     # apply to one of the two types of data
@@ -289,6 +856,79 @@ def all_vs30s_given_correlations(
     return database_df
 
 
+def _read_sql_for_one_nzgd(
+    query: str, selected_nzgd_id: int, conn: sqlite3.Connection
+) -> pd.DataFrame:
+    """
+    Reads the result of a query with a single NZGD ID parameter.
+
+    A record's page and its downloads read the same data, usually in quick succession,
+    so the most recently read results are cached in memory. They are read again if the
+    database file is modified or replaced.
+
+    The cache is keyed on the database file rather than the connection, so a result that is
+    not already cached is read with the current thread's connection from get_conn, not conn.
+    Databases that are not stored in a file (e.g. in-memory or temporary databases) are read
+    through conn without caching.
+
+    Parameters
+    ----------
+    query : str
+        The SQL query, with a single ? placeholder for the NZGD ID.
+    selected_nzgd_id : int
+        The selected NZGD ID.
+    conn : sqlite3.Connection
+        The SQLite database connection, which is used to find the database file.
+
+    Returns
+    -------
+    pd.DataFrame
+        A copy of the query result, so it can be modified by the caller.
+    """
+
+    database_file = _database_file(conn)
+    if not database_file:
+        return pd.read_sql(query, conn, params=(selected_nzgd_id,))
+
+    return _cached_read_sql_for_one_nzgd(
+        database_file,
+        database_version(database_file),
+        query,
+        selected_nzgd_id,
+    ).copy()
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_read_sql_for_one_nzgd(
+    database_file: str,
+    database_file_version: tuple[int, int],
+    query: str,
+    selected_nzgd_id: int,
+) -> pd.DataFrame:
+    """
+    Reads the result of a query for _read_sql_for_one_nzgd, which caches the result.
+
+    Parameters
+    ----------
+    database_file : str
+        The path to the SQLite database file.
+    database_file_version : tuple[int, int]
+        The version of the database file from database_version. This is only used as part of the
+        cache key, so that the cached data is not used after the database has been modified or replaced.
+    query : str
+        The SQL query, with a single ? placeholder for the NZGD ID.
+    selected_nzgd_id : int
+        The selected NZGD ID.
+
+    Returns
+    -------
+    pd.DataFrame
+        The query result.
+    """
+
+    return pd.read_sql(query, get_conn(database_file), params=(selected_nzgd_id,))
+
+
 def cpt_measurements_for_one_nzgd(
     selected_nzgd_id: int, conn: sqlite3.Connection
 ) -> pd.DataFrame:
@@ -322,13 +962,10 @@ def cpt_measurements_for_one_nzgd(
     WHERE cptreport.nzgd_id = ?
     ORDER BY cptmeasurements.depth ASC;"""
 
-    t1 = time.time()
-    cpt_measurements_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
-    t2 = time.time()
-
-    print(
-        f"Time to extract CPT measurements for cpt_id={selected_nzgd_id} from SQLite: {t2 - t1:.2f} s"
-    )
+    with _debug_timer(
+        "Time to extract CPT measurements for nzgd_id=%s from SQLite", selected_nzgd_id
+    ):
+        cpt_measurements_df = _read_sql_for_one_nzgd(query, selected_nzgd_id, conn)
 
     return cpt_measurements_df
 
@@ -360,13 +997,10 @@ def spt_measurements_for_one_nzgd(
     WHERE sptmeasurements.borehole_id = ?
     ORDER BY sptmeasurements.depth ASC;"""
 
-    t1 = time.time()
-    spt_measurements_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
-    t2 = time.time()
-
-    print(
-        f"Time to extract CPT measurements for cpt_id={selected_nzgd_id} from SQLite: {t2 - t1:.2f} s"
-    )
+    with _debug_timer(
+        "Time to extract SPT measurements for nzgd_id=%s from SQLite", selected_nzgd_id
+    ):
+        spt_measurements_df = _read_sql_for_one_nzgd(query, selected_nzgd_id, conn)
 
     return spt_measurements_df
 
@@ -390,28 +1024,22 @@ def spt_soil_types_for_one_nzgd(
         A DataFrame containing the soil types and related metadata.
     """
 
-    # SQL query to join multiple tables and extract soil types for the given NZGD ID
-    query = """SELECT *
+    # SQL query to join multiple tables and extract soil types for the given NZGD ID.
+    # top_depth is rounded to 4 decimals to avoid floating point precision issues, and if a single
+    # soil layer has multiple soil types, they are concatenated into a single string.
+    query = """SELECT
+    ROUND(soilmeasurements.top_depth, 4) AS top_depth,
+    MIN(sptreport.nzgd_id) AS nzgd_id,
+    GROUP_CONCAT(soiltypes.name, ' + ') AS soil_type
     FROM sptreport
     JOIN soilmeasurements ON soilmeasurements.report_id = sptreport.borehole_id
     JOIN soilmeasurementsoiltype ON soilmeasurementsoiltype.soil_measurement_id = soilmeasurements.measurement_id
     JOIN soiltypes ON soilmeasurementsoiltype.soil_type_id = soiltypes.id
     WHERE sptreport.borehole_id = ?
-    ORDER BY soilmeasurements.top_depth ASC;"""
-
-    spt_soil_types_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
+    GROUP BY ROUND(soilmeasurements.top_depth, 4)
+    ORDER BY top_depth ASC;"""
 
-    spt_soil_types_df.rename(columns={"name": "soil_type"}, inplace=True)
-
-    spt_soil_types_df = spt_soil_types_df[["nzgd_id", "top_depth", "soil_type"]]
-
-    # round top_depth to 3 decimals to avoid floating point precision issues
-    spt_soil_types_df["top_depth"] = spt_soil_types_df["top_depth"].round(4)
-
-    # If a single soil layer has multiple soil types, concatenate them into a single string
-    spt_soil_types_df = spt_soil_types_df.groupby(
-        "top_depth", sort=False, as_index=False
-    ).agg({"nzgd_id": "first", "soil_type": lambda x: " + ".join(x)})
+    spt_soil_types_df = _read_sql_for_one_nzgd(query, selected_nzgd_id, conn)
 
     # Shift the diffs back by one row so that the first row has the correct layer thickness
     spt_soil_types_df["layer_thickness"] = (
@@ -490,30 +1118,20 @@ def cpt_vs30s_for_one_nzgd_id(
         ON nzgdrecord.suburb_id = suburb.suburb_id
     JOIN city
         ON nzgdrecord.city_id = city.city_id
-    WHERE cptvs30estimates.nzgd_id = ?;"""
+    WHERE cptvs30estimates.nzgd_id = ?
+    ORDER BY cptvs30estimates.rowid;"""
 
-    t1 = time.time()
-    cpt_vs30_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
+    with _debug_timer(
+        "Time to extract Vs30s for nzgd_id=%s from SQLite", selected_nzgd_id
+    ):
+        cpt_vs30_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
 
     # Add columns needed for the web app
-    cpt_vs30_df["record_name"] = (
-        cpt_vs30_df["type_prefix"].astype(str)
-        + "_"
-        + cpt_vs30_df["nzgd_id"].astype(str)
+    cpt_vs30_df["record_name"] = _record_names(
+        cpt_vs30_df["type_prefix"], cpt_vs30_df["nzgd_id"]
     )
 
-    # Missing values (nan or None) will raise a TypeError when trying to calculate the residuals
-    # so in those cases, set the residuals to nan
-    try:
-        cpt_vs30_df["vs30_log_residual"] = np.log(cpt_vs30_df["vs30"]) - np.log(
-            cpt_vs30_df["model_vs30_foster_2019"]
-        )
-    except TypeError:
-        cpt_vs30_df["vs30_log_residual"] = np.nan
-
-    cpt_vs30_df["gwl_residual"] = (
-        cpt_vs30_df["measured_gwl"] - cpt_vs30_df["model_gwl_westerhoff_2019"]
-    )
+    _add_residual_columns(cpt_vs30_df)
 
     # rename the columns to match the web app and add prefixes of cpt spt to columns that only
     # apply to one of the two types of data
@@ -526,12 +1144,6 @@ def cpt_vs30s_for_one_nzgd_id(
         inplace=True,
     )
 
-    t2 = time.time()
-
-    print(
-        f"Time to extract Vs30s for nzgd_id={selected_nzgd_id} from SQLite: {t2 - t1:.2f} s"
-    )
-
     return cpt_vs30_df
 
 
@@ -599,10 +1211,13 @@ def spt_vs30s_for_one_nzgd_id(
         ON nzgdrecord.suburb_id = suburb.suburb_id
     JOIN city
         ON nzgdrecord.city_id = city.city_id
-    WHERE sptvs30estimates.spt_id = ?;"""
+    WHERE sptvs30estimates.spt_id = ?
+    ORDER BY sptvs30estimates.rowid;"""
 
-    t1 = time.time()
-    spt_vs30_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
+    with _debug_timer(
+        "Time to extract Vs30s for nzgd_id=%s from SQLite", selected_nzgd_id
+    ):
+        spt_vs30_df = pd.read_sql(query, conn, params=(selected_nzgd_id,))
     spt_vs30_df.rename(columns={"spt_id": "nzgd_id"}, inplace=True)
 
     spt_measurements_df = spt_measurements_for_one_nzgd(selected_nzgd_id, conn)
@@ -611,22 +1226,9 @@ def spt_vs30s_for_one_nzgd_id(
     spt_vs30_df["shallowest_depth"] = spt_measurements_df["depth"].min()
 
     # Add columns needed for the web app
-    spt_vs30_df["record_name"] = (
-        spt_vs30_df["type_prefix"].astype(str)
-        + "_"
-        + spt_vs30_df["nzgd_id"].astype(str)
-    )
-    spt_vs30_df["vs30_log_residual"] = np.log(spt_vs30_df["vs30"]) - np.log(
-        spt_vs30_df["model_vs30_foster_2019"]
-    )
-    spt_vs30_df["gwl_residual"] = (
-        spt_vs30_df["measured_gwl"] - spt_vs30_df["model_gwl_westerhoff_2019"]
-    )
-
-    t2 = time.time()
-
-    print(
-        f"Time to extract Vs30s for nzgd_id={selected_nzgd_id} from SQLite: {t2 - t1:.2f} s"
+    spt_vs30_df["record_name"] = _record_names(
+        spt_vs30_df["type_prefix"], spt_vs30_df["nzgd_id"]
     )
+    _add_residual_columns(spt_vs30_df)
 
-    return spt_vs30_df
\ No newline at end of file
+    return spt_vs30_df
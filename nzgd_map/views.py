@@ -3,17 +3,19 @@ The views module defines the Flask views (web pages) for the application.
 Each view is a function that returns an HTML template to render in the browser.
 """
 
+import functools
 import os
-import sqlite3
-from collections import OrderedDict
-from io import StringIO
+import re
+import urllib.parse
+from collections.abc import Iterator
 from pathlib import Path
+from typing import Any
 
 import flask
 import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 from flask import after_this_request
 from plotly.subplots import make_subplots
 
@@ -22,6 +24,156 @@ from . import constants, query_sqlite_db
 # Create a Flask Blueprint for the views
 bp = flask.Blueprint("views", __name__)
 
+# Serialise the figures sent to the browser with orjson (a dependency), which is much
+# faster than the standard library's json module for the large arrays in the map
+pio.json.config.default_engine = "orjson"
+
+# An empty DataFrame with the queryable column names, used by validate(). It is
+# built once at import rather than on every keystroke in the query box.
+_validation_df = pd.DataFrame(columns=constants.query_column_names)
+
+# The exceptions raised by DataFrame.query for an invalid query. TypeError is raised by
+# comparisons that are invalid for a column's type (e.g. between a region and a string that is
+# not a region), which are only found when the query is run on the records.
+_query_exceptions = (
+    ValueError,
+    SyntaxError,
+    TypeError,
+    UnboundLocalError,
+    pd.errors.UndefinedVariableError,
+)
+
+# The column names listed on the index page as available for queries
+_col_names_to_display = [
+    "record_name",
+    "nzgd_id",
+    "cpt_id",
+    "vs30",
+    "vs30_stddev",
+    "type_prefix",
+    "original_reference",
+    "investigation_date",
+    "published_date",
+    "latitude",
+    "longitude",
+    "model_vs30_foster_2019",
+    "model_vs30_stddev_foster_2019",
+    "model_gwl_westerhoff_2019",
+    "cpt_tip_net_area_ratio",
+    "measured_gwl",
+    "deepest_depth",
+    "shallowest_depth",
+    "region",
+    "district",
+    "suburb",
+    "city",
+    "vs30_log_residual",
+    "gwl_residual",
+    "spt_efficiency",
+]
+_col_names_to_display_str = ", ".join(_col_names_to_display)
+
+# The number of rows written at a time when streaming a CSV download
+_csv_chunk_size = 10_000
+
+# The hover text shown for each record on the index map, in the same format as Plotly Express
+_map_hovertemplate = (
+    "<b>%{hovertext}</b><br><br>latitude=%{lat}<br>longitude=%{lon}"
+    "<br>deepest_depth (m)=%{customdata[0]:.2f}<br>Vs30 (m/s)=%{customdata[1]}"
+    "<br>Vs30_log_resid=%{customdata[2]}"
+)
+
+
+def _fmt(value: Any, spec: str = "{:.2f}", na: str = "Not available") -> Any:
+    """
+    Format a value from a record for display on the record pages.
+
+    Parameters
+    ----------
+    value : Any
+        The value to format.
+    spec : str, optional
+        The format string for float values. Defaults to two decimal places.
+    na : str, optional
+        The text to show if the value is missing (None or NaN).
+
+    Returns
+    -------
+    Any
+        The formatted string for a float value, the na text for a missing value,
+        or otherwise the value unchanged.
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return na
+    if isinstance(value, float):
+        return spec.format(value)
+    return value
+
+
+def _yes_or_no(flag: Any) -> Any:
+    """
+    Show a 0/1 flag from the database as "no"/"yes", leaving any other value unchanged.
+
+    Parameters
+    ----------
+    flag : Any
+        The flag value.
+
+    Returns
+    -------
+    Any
+        "no" for 0, "yes" for 1, or otherwise the flag value unchanged.
+    """
+    return {0: "no", 1: "yes"}.get(flag, flag)
+
+
+def _nzgd_id(name: str) -> int:
+    """
+    Get the NZGD ID from a record name (e.g. "CPT_123") or a download filename
+    (e.g. "CPT_123_data.csv").
+
+    Parameters
+    ----------
+    name : str
+        The record name or filename.
+
+    Returns
+    -------
+    int
+        The NZGD ID.
+    """
+    return int(name.partition("_")[2].partition("_")[0])
+
+
+def _query_engine(df: pd.DataFrame, query: str) -> str:
+    """
+    Choose the engine for evaluating a query on the records with DataFrame.query.
+
+    Queries are evaluated with numexpr (a dependency), unless they use one of the Arrow-backed
+    string columns, which numexpr does not support. pandas would otherwise switch those queries
+    to the python engine itself, with a RuntimeWarning for every query.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The records the query is evaluated on.
+    query : str
+        The query string.
+
+    Returns
+    -------
+    str
+        "python" if the query uses an Arrow-backed column, or otherwise "numexpr".
+    """
+    arrow_columns = {
+        column
+        for column, dtype in df.dtypes.items()
+        if isinstance(dtype, (pd.ArrowDtype, pd.StringDtype))
+    }
+    if arrow_columns.intersection(re.findall(r"[A-Za-z_]\w*", query)):
+        return "python"
+    return "numexpr"
+
 
 @bp.route("/", methods=["GET"])
 def index():
@@ -29,46 +181,87 @@ def index():
     # Access the instance folder for application-specific data
     instance_path = Path(flask.current_app.instance_path)
 
+    return _index_page(
+        instance_path,
+        query_sqlite_db.database_version(instance_path / constants.database_file_name),
+        (instance_path / constants.last_retrieval_date_file_name).stat().st_mtime_ns,
+        flask.request.query_string,
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _index_page(
+    instance_path: Path,
+    database_file_version: tuple[int, int],
+    retrieval_date_mtime_ns: int,
+    query_string: bytes,
+) -> str:
+    """
+    Render the index page for the selections in the request's query string.
+
+    The rendered page only depends on the query string, the database and the date of the last
+    NZGD retrieval, so it is cached, and the map and histogram are not rebuilt when the same
+    selections are requested again.
+
+    Parameters
+    ----------
+    instance_path : Path
+        The instance folder containing the database.
+    database_file_version : tuple[int, int]
+        The version of the database file from query_sqlite_db.database_version, so that the
+        cached pages are not reused after the database is modified or replaced.
+    retrieval_date_mtime_ns : int
+        The modification time of the file containing the date of the last NZGD retrieval,
+        so that the cached pages are not reused after the date is updated.
+    query_string : bytes
+        The query string of the request, which the page's selections are read from.
+
+    Returns
+    -------
+    str
+        The rendered HTML of the index page.
+    """
     with open(instance_path / constants.last_retrieval_date_file_name, "r") as file:
         date_of_last_nzgd_retrieval = file.readline()
 
+    # Read the selections from the query string that the page is cached on, rather than from
+    # flask.request.args. As with flask.request.args.get, the first value of a repeated
+    # argument is used.
+    args = {}
+    for name, value in urllib.parse.parse_qsl(
+        query_string.decode("utf-8", "replace"), keep_blank_values=True
+    ):
+        args.setdefault(name, value)
+
     # Retrieve selected vs30 correlation. If no selection, default to "boore_2004"
-    vs30_correlation = flask.request.args.get(
-        "vs30_correlation", default=constants.default_vs_to_vs30_correlation
+    vs30_correlation = args.get(
+        "vs30_correlation", constants.default_vs_to_vs30_correlation
     )
 
     # Retrieve selected spt_vs_correlation. If no selection, default to "brandenberg_2010"
-    spt_vs_correlation = flask.request.args.get(
-        "spt_vs_correlation", default=constants.default_spt_to_vs_correlation
+    spt_vs_correlation = args.get(
+        "spt_vs_correlation", constants.default_spt_to_vs_correlation
     )
 
     # Retrieve selected cpt_vs_correlation. If no selection, default to "andrus_2007_pleistocene".
-    cpt_vs_correlation = flask.request.args.get(
-        "cpt_vs_correlation", default=constants.default_cpt_to_vs_correlation
+    cpt_vs_correlation = args.get(
+        "cpt_vs_correlation", constants.default_cpt_to_vs_correlation
     )
 
     # Retrieve selected column to color by on the map. If no selection, default to "vs30".
-    colour_by = flask.request.args.get("colour_by", default="vs30")
+    colour_by = args.get("colour_by", "vs30")
 
     # Retrieve selected column to plot as a histogram. If no selection, default to "vs30_log_residual".
-    hist_by = flask.request.args.get(
+    hist_by = args.get(
         "hist_by",
-        default="vs30_log_residual",  # Default value if no query parameter is provided
+        "vs30_log_residual",  # Default value if no query parameter is provided
     )
 
     # Retrieve an optional custom query from request arguments
-    query = flask.request.args.get("query", default=None)
+    query = args.get("query", None)
 
-    with sqlite3.connect(instance_path / constants.database_file_name) as conn:
-        vs_to_vs30_correlation_df = pd.read_sql_query(
-            "SELECT * FROM vstovs30correlation", conn
-        )
-        cpt_to_vs_correlation_df = pd.read_sql_query(
-            "SELECT * FROM cpttovscorrelation", conn
-        )
-        spt_to_vs_correlation_df = pd.read_sql_query(
-            "SELECT * FROM spttovscorrelation", conn
-        )
+    with query_sqlite_db.get_conn(instance_path / constants.database_file_name) as conn:
+        lookup_ids = query_sqlite_db.correlation_and_hammer_type_ids(conn)
 
         database_df = query_sqlite_db.all_vs30s_given_correlations(
             selected_vs30_correlation=vs30_correlation,
@@ -76,92 +269,127 @@ def index():
             selected_spt_to_vs_correlation=spt_vs_correlation,
             selected_hammer_type="Auto",
             conn=conn,
+            parquet_cache_dir=instance_path / constants.parquet_cache_dir_name,
         )
 
     database_df["vs30"] = query_sqlite_db.clip_highest_and_lowest_percent(
         database_df["vs30"], 0.1, 99.9
     )
 
-    # Retrieve the available correlation options from the database dataframe to
-    # populate the dropdowns in the user interface. Ignore None values.
-    vs30_correlations = vs_to_vs30_correlation_df["name"].unique()
-    cpt_vs_correlations = cpt_to_vs_correlation_df["name"].unique()
-    spt_vs_correlations = spt_to_vs_correlation_df["name"].unique()
+    # Retrieve the available correlation options from the cached lookup tables to
+    # populate the dropdowns in the user interface.
+    vs30_correlations = list(lookup_ids["vs_to_vs30_correlation"])
+    cpt_vs_correlations = list(lookup_ids["cpt_to_vs_correlation"])
+    spt_vs_correlations = list(lookup_ids["spt_to_vs_correlation"])
 
     # Apply custom query filtering if provided
+    query_error = None
     if query:
-        database_df = database_df.query(query)
+        try:
+            database_df = database_df.query(
+                query, engine=_query_engine(database_df, query)
+            )
+        except _query_exceptions as e:
+            # Show the error with all the records, rather than failing to render the page
+            query_error = str(e)
 
     #########################################################################################
 
     # Calculate the center of the map for visualization
-    centre_lat = database_df["latitude"].mean()
-    centre_lon = database_df["longitude"].mean()
+    centre_lat = float(np.nanmean(database_df["latitude"].to_numpy()))
+    centre_lon = float(np.nanmean(database_df["longitude"].to_numpy()))
 
     ## Make map marker sizes proportional to the absolute value of the Vs30 log residual.
     ## For records where the Vs30 log residual is unavailable, use the median of absolute value of the Vs30 log residuals.
-    database_df["size"] = (
-        database_df["vs30_log_residual"]
-        .abs()
-        .fillna(database_df["vs30_log_residual"].abs().median().round(1))
+    abs_vs30_log_residual = np.abs(database_df["vs30_log_residual"].to_numpy())
+    database_df["size"] = np.where(
+        np.isnan(abs_vs30_log_residual),
+        np.round(np.nanmedian(abs_vs30_log_residual), 1),
+        abs_vs30_log_residual,
     )
     marker_size_description_text = r"Marker size indicates the magnitude of the Vs30 log residual, given by \(\mathrm{|(\log(SPT_{Vs30}) - \log(Foster2019_{Vs30})|}\)"
 
-    ## Make new columns of string values to display instead of the float values for Vs30 and log residual
+    ## Make arrays of string values to display instead of the float values for Vs30 and log residual
     ## so that an explanation can be shown when the vs30 value or the log residual
-    database_df["Vs30 (m/s)"] = database_df["vs30"]
-    database_df["Vs30_log_resid"] = database_df["vs30_log_residual"]
     if vs30_correlation == "boore_2011":
         reason_text = "Unable to estimate as Boore et al. (2011) Vs to Vs30 correlation requires a depth of at least 5 m"
         min_required_depth = 5
     else:
         reason_text = "Unable to estimate as Boore et al. (2004) Vs to Vs30 correlation requires a depth of at least 10 m"
         min_required_depth = 10
-    database_df.loc[database_df["deepest_depth"] < min_required_depth, "Vs30 (m/s)"] = (
-        reason_text
-    )
-    database_df.loc[
-        (database_df["deepest_depth"] >= min_required_depth)
-        & (np.isnan(database_df["vs30"]) | (database_df["vs30"] == 0)),
-        "Vs30 (m/s)",
-    ] = "Vs30 calculation failed even though CPT depth is sufficient"
-    database_df.loc[
-        (database_df["deepest_depth"] >= min_required_depth)
-        & ~(np.isnan(database_df["vs30"]) | (database_df["vs30"] == 0)),
-        "Vs30 (m/s)",
-    ] = database_df["vs30"].apply(lambda x: f"{x:.2f}")
-    database_df.loc[(np.isnan(database_df["vs30_log_residual"])), "Vs30_log_resid"] = (
-        "Unavailable as Vs30 could not be calculated"
+    deepest_depth = database_df["deepest_depth"].to_numpy()
+    vs30 = database_df["vs30"].to_numpy()
+    vs30_failed = np.isnan(vs30) | (vs30 == 0)
+    deep_enough = deepest_depth >= min_required_depth
+
+    # Format only the values that are shown, using a list comprehension over Python floats
+    # rather than a per-row Series.apply. Records without a deepest depth show the unformatted value.
+    vs30_formatted = vs30.astype(object)
+    vs30_available = deep_enough & ~vs30_failed
+    vs30_formatted[vs30_available] = [f"{x:.2f}" for x in vs30[vs30_available].tolist()]
+    vs30_text = np.select(
+        [deepest_depth < min_required_depth, deep_enough & vs30_failed],
+        [reason_text, "Vs30 calculation failed even though CPT depth is sufficient"],
+        default=vs30_formatted,
     )
-    database_df.loc[~(np.isnan(database_df["vs30_log_residual"])), "Vs30_log_resid"] = (
-        database_df["vs30_log_residual"].apply(lambda x: f"{x:.2f}")
+
+    vs30_log_residual = database_df["vs30_log_residual"].to_numpy()
+    residual_text = np.full(
+        len(vs30_log_residual),
+        "Unavailable as Vs30 could not be calculated",
+        dtype=object,
     )
-    database_df["deepest_depth (m)"] = database_df["deepest_depth"]
-
-    # Create an interactive scatter map using Plotly
-    map = px.scatter_map(
-        database_df,
-        lat="latitude",  # Column specifying latitude
-        lon="longitude",  # Column specifying longitude
-        color=colour_by,  # Column specifying marker color
-        hover_name=database_df["record_name"],
-        zoom=5,
-        size="size",  # Marker size
-        center={"lat": centre_lat, "lon": centre_lon},  # Map center
-        hover_data=OrderedDict(
-            [  # Used to order the items in hover data (but lat and long are always first)
-                ("deepest_depth (m)", ":.2f"),
-                ("Vs30 (m/s)", True),
-                ("Vs30_log_resid", True),
-                ("size", False),
-                ("vs30", False),
-                ("vs30_log_residual", False),
-            ]
+    residual_available = ~np.isnan(vs30_log_residual)
+    residual_text[residual_available] = [
+        f"{x:.2f}" for x in vs30_log_residual[residual_available].tolist()
+    ]
+
+    # Create an interactive scatter map using Plotly. The trace is built directly with graph objects
+    # rather than px.scatter_map, which skips Plotly Express's processing of every column and only
+    # includes the hover values that are shown. The columns are passed as numpy arrays so that
+    # Plotly sends the numeric ones to the browser as base64-encoded typed arrays.
+    map_hovertemplate = _map_hovertemplate
+    # Show the value being coloured by, unless it is already shown in the hover text
+    if colour_by not in ["vs30", "vs30_log_residual"]:
+        map_hovertemplate += f"<br>{colour_by}=%{{marker.color}}"
+    map = go.Figure(
+        go.Scattermap(
+            lat=database_df["latitude"].to_numpy(),
+            lon=database_df["longitude"].to_numpy(),
+            mode="markers",
+            marker={
+                "color": database_df[colour_by].to_numpy(),
+                "coloraxis": "coloraxis",
+                "size": database_df["size"].to_numpy(),
+                "sizemode": "area",
+                # Scale the markers in the same way as px.scatter_map's default size_max of 20
+                "sizeref": database_df["size"].max() / 20**2,
+            },
+            hovertext=database_df["record_name"].to_numpy(),
+            customdata=np.column_stack([deepest_depth, vs30_text, residual_text]),
+            hovertemplate=map_hovertemplate + "<extra></extra>",
         ),
+        layout={
+            "map": {"center": {"lat": centre_lat, "lon": centre_lon}, "zoom": 5},
+            "coloraxis": {"colorbar": {"title": {"text": colour_by}}},
+            "margin": {"t": 60},
+        },
     )
 
-    # Create an interactive histogram using Plotly
-    hist_plot = px.histogram(database_df, x=hist_by)
+    # Create an interactive histogram using Plotly. As with the map, the trace is built directly
+    # with graph objects, using the same hover text and axis titles as px.histogram.
+    hist_plot = go.Figure(
+        go.Histogram(
+            x=database_df[hist_by].to_numpy(),
+            hovertemplate=f"{hist_by}=%{{x}}<br>count=%{{y}}<extra></extra>",
+        ),
+        layout={
+            "xaxis": {"title": {"text": hist_by}},
+            "yaxis": {"title": {"text": "count"}},
+            "margin": {"t": 60},
+            "barmode": "relative",
+        },
+    )
     hist_description_text = (
         f"Histogram of {hist_by}, showing {len(database_df)} records"
     )
@@ -172,48 +400,18 @@ def index():
     else:
         residual_description_text = ""
 
-    col_names_to_display = [
-        "record_name",
-        "nzgd_id",
-        "cpt_id",
-        "vs30",
-        "vs30_stddev",
-        "type_prefix",
-        "original_reference",
-        "investigation_date",
-        "published_date",
-        "latitude",
-        "longitude",
-        "model_vs30_foster_2019",
-        "model_vs30_stddev_foster_2019",
-        "model_gwl_westerhoff_2019",
-        "cpt_tip_net_area_ratio",
-        "measured_gwl",
-        "deepest_depth",
-        "shallowest_depth",
-        "region",
-        "district",
-        "suburb",
-        "city",
-        "vs30_log_residual",
-        "gwl_residual",
-        "spt_efficiency",
-    ]
-    col_names_to_display_str = ", ".join(col_names_to_display)
-
     # Render the map and data in an HTML template
     return flask.render_template(
         "views/index.html",
         date_of_last_nzgd_retrieval=date_of_last_nzgd_retrieval,
-        map=map.to_html(
-            full_html=False,  # Embed only the necessary map HTML
-            include_plotlyjs=False,  # Exclude Plotly.js library (assume it's loaded separately)
-            default_height="85vh",  # Set the map height
-        ),
+        # Pass the figures as JSON so the template can draw them with Plotly.react,
+        # rather than serialising them to HTML with to_html()
+        map_json=pio.to_json(map, validate=False),
         selected_vs30_correlation=vs30_correlation,  # Pass the selected vs30_correlation for the template
         selected_spt_vs_correlation=spt_vs_correlation,
         selected_cpt_vs_correlation=cpt_vs_correlation,
         query=query,  # Pass the query back for persistence in UI
+        query_error=query_error,
         vs30_correlations=vs30_correlations,  # Pass all vs30_correlations for UI dropdown
         spt_vs_correlations=spt_vs_correlations,
         cpt_vs_correlations=cpt_vs_correlations,
@@ -238,15 +436,11 @@ def index():
                 "Groundwater level from Westerhoff et al. (2019)",
             ),
         ],
-        hist_plot=hist_plot.to_html(
-            full_html=False,  # Embed only the necessary map HTML
-            include_plotlyjs=False,  # Exclude Plotly.js library (assume it's loaded separately)
-            default_height="85vh",  # Set the map height
-        ),
+        hist_plot_json=pio.to_json(hist_plot, validate=False),
         marker_size_description_text=marker_size_description_text,
         hist_description_text=hist_description_text,
         residual_description_text=residual_description_text,
-        col_names_to_display=col_names_to_display_str,
+        col_names_to_display=_col_names_to_display_str,
     )
 
 
@@ -268,9 +462,9 @@ def spt_record(record_name: str):
     # Access the instance folder for application-specific data
     instance_path = Path(flask.current_app.instance_path)
 
-    nzgd_id = int(record_name.split("_")[1])
+    nzgd_id = _nzgd_id(record_name)
 
-    with sqlite3.connect(instance_path / constants.database_file_name) as conn:
+    with query_sqlite_db.get_conn(instance_path / constants.database_file_name) as conn:
         spt_measurements_df = query_sqlite_db.spt_measurements_for_one_nzgd(
             nzgd_id, conn
         )
@@ -279,88 +473,82 @@ def spt_record(record_name: str):
 
     type_prefix_to_folder = {"CPT": "cpt", "SCPT": "scpt", "BH": "borehole"}
 
+    # The record's metadata is the same in every row, so it is taken from the first row once
+    record = vs30s_df.iloc[0]
+
     path_to_files = (
-        Path(type_prefix_to_folder[vs30s_df["type_prefix"][0]])
-        / vs30s_df["region"][0]
-        / vs30s_df["district"][0]
-        / vs30s_df["city"][0]
-        / vs30s_df["suburb"][0]
-        / vs30s_df["record_name"][0]
+        Path(type_prefix_to_folder[record["type_prefix"]])
+        / record["region"]
+        / record["district"]
+        / record["city"]
+        / record["suburb"]
+        / record["record_name"]
     )
     url_str = constants.source_files_base_url + str(path_to_files)
-    vs30s_df["estimate_number"] = np.arange(1, len(vs30s_df) + 1)
-
-    spt_efficiency = vs30s_df["spt_efficiency"][0]
-    if spt_efficiency is None:
-        spt_efficiency = "Not available"
-    elif isinstance(spt_efficiency, float):
-        spt_efficiency = f"{spt_efficiency:.0f}%"
-
-    spt_borehole_diameter = vs30s_df["spt_borehole_diameter"][0]
-    if spt_borehole_diameter is None:
-        spt_borehole_diameter = "Not available"
-    elif isinstance(spt_borehole_diameter, float):
-        spt_borehole_diameter = f"{spt_borehole_diameter:.2f}"
-
-    measured_gwl = vs30s_df["measured_gwl"][0]
-    if measured_gwl is None:
-        measured_gwl = "Not available"
-    elif isinstance(measured_gwl, float):
-        measured_gwl = f"{measured_gwl:.2f}"
-
-    model_gwl_westerhoff_2019 = vs30s_df["model_gwl_westerhoff_2019"][0]
-    if model_gwl_westerhoff_2019 is None:
-        model_gwl_westerhoff_2019 = "Not available"
-    elif isinstance(model_gwl_westerhoff_2019, float):
-        model_gwl_westerhoff_2019 = f"{model_gwl_westerhoff_2019:.2f}"
-
-    model_vs30_foster_2019 = vs30s_df["model_vs30_foster_2019"][0]
-    if model_vs30_foster_2019 is None:
-        model_vs30_foster_2019 = "Not available"
-    elif isinstance(model_vs30_foster_2019, float):
-        model_vs30_foster_2019 = f"{model_vs30_foster_2019:.2f}"
-
-    model_vs30_stddev_foster_2019 = vs30s_df["model_vs30_stddev_foster_2019"][0]
-    if model_vs30_stddev_foster_2019 is None:
-        model_vs30_stddev_foster_2019 = "Not available"
-    elif isinstance(model_vs30_stddev_foster_2019, float):
-        model_vs30_stddev_foster_2019 = f"{model_vs30_stddev_foster_2019:.2f}"
-
-    spt_vs30_calculation_used_efficiency = vs30s_df[
-        "spt_vs30_calculation_used_soil_info"
-    ][0]
-    if spt_vs30_calculation_used_efficiency == 0:
-        spt_vs30_calculation_used_efficiency = "no"
-    elif spt_vs30_calculation_used_efficiency == 1:
-        spt_vs30_calculation_used_efficiency = "yes"
-
-    spt_vs30_calculation_used_soil_info = vs30s_df[
-        "spt_vs30_calculation_used_efficiency"
-    ][0]
-    if spt_vs30_calculation_used_soil_info == 0:
-        spt_vs30_calculation_used_soil_info = "no"
-    elif spt_vs30_calculation_used_soil_info == 1:
-        spt_vs30_calculation_used_soil_info = "yes"
-
-    spt_measurements_df.rename(
-        columns={"n": "Number of blows", "depth": "Depth (m)"}, inplace=True
+    vs30s_df["estimate_number"] = np.arange(1, len(vs30s_df) + 1, dtype=np.int32)
+
+    spt_efficiency = _fmt(record["spt_efficiency"], spec="{:.0f}%")
+
+    spt_borehole_diameter = _fmt(record["spt_borehole_diameter"])
+
+    measured_gwl = _fmt(record["measured_gwl"])
+
+    model_gwl_westerhoff_2019 = _fmt(record["model_gwl_westerhoff_2019"])
+
+    model_vs30_foster_2019 = _fmt(record["model_vs30_foster_2019"])
+
+    model_vs30_stddev_foster_2019 = _fmt(record["model_vs30_stddev_foster_2019"])
+
+    spt_vs30_calculation_used_efficiency = _yes_or_no(
+        record["spt_vs30_calculation_used_efficiency"]
+    )
+    spt_vs30_calculation_used_soil_info = _yes_or_no(
+        record["spt_vs30_calculation_used_soil_info"]
     )
 
     # Plot the SPT data. line_shape is set to "vhv" to create a step plot with the correct orientation for vertical depth.
-    spt_plot = px.line(
-        spt_measurements_df, x="Number of blows", y="Depth (m)", line_shape="vhv"
+    # The figure is built with graph objects, as Plotly Express's DataFrame processing is slow relative to a small plot.
+    spt_plot = go.Figure(
+        go.Scatter(
+            x=spt_measurements_df["n"].to_numpy(),
+            y=spt_measurements_df["depth"].to_numpy(),
+            mode="lines",
+            line_shape="vhv",
+            hovertemplate="Number of blows=%{x}<br>Depth (m)=%{y}<extra></extra>",
+        ),
+        layout={
+            "xaxis": {"title": {"text": "Number of blows"}},
+            # Invert the y-axis
+            "yaxis": {"title": {"text": "Depth (m)"}, "autorange": "reversed"},
+            "margin": {"t": 60},
+        },
     )
-    # Invert the y-axis
-    spt_plot.update_layout(yaxis=dict(autorange="reversed"))
 
     return flask.render_template(
         "views/spt_record.html",
-        record_details=vs30s_df.to_dict(
+        # Pass the columns used by the template as a list of dictionaries
+        record_details=vs30s_df[constants.spt_record_details_columns].to_dict(
             orient="records"
-        ),  # Pass DataFrame as list of dictionaries
-        spt_data=spt_measurements_df.to_dict(orient="records"),
-        soil_type=spt_soil_df.to_dict(orient="records"),
-        spt_plot=spt_plot.to_html(),
+        ),
+        # Pass the measurements and soil types as rows of the displayed values, rather than
+        # a dictionary per row
+        spt_data=list(
+            zip(
+                spt_measurements_df["depth"].tolist(),
+                spt_measurements_df["n"].tolist(),
+            )
+        ),
+        soil_type=list(
+            zip(
+                spt_soil_df["top_depth"].tolist(),
+                spt_soil_df["layer_thickness"].tolist(),
+                spt_soil_df["soil_type"].tolist(),
+            )
+        ),
+        spt_plot=spt_plot.to_html(
+            full_html=False,  # Embed only the necessary plot HTML
+            include_plotlyjs=False,  # Plotly.js is loaded by base.html
+        ),
         url_str=url_str,
         spt_efficiency=spt_efficiency,
         spt_borehole_diameter=spt_borehole_diameter,
@@ -368,8 +556,8 @@ def spt_record(record_name: str):
         model_vs30_foster_2019=model_vs30_foster_2019,
         model_vs30_stddev_foster_2019=model_vs30_stddev_foster_2019,
         model_gwl_westerhoff_2019=model_gwl_westerhoff_2019,
-        max_depth=spt_measurements_df["Depth (m)"].max(),
-        min_depth=spt_measurements_df["Depth (m)"].min(),
+        max_depth=spt_measurements_df["depth"].max(),
+        min_depth=spt_measurements_df["depth"].min(),
         spt_vs30_calculation_used_efficiency=spt_vs30_calculation_used_efficiency,
         spt_vs30_calculation_used_soil_info=spt_vs30_calculation_used_soil_info,
     )
@@ -393,64 +581,43 @@ def cpt_record(record_name: str):
     # Access the instance folder for application-specific data
     instance_path = Path(flask.current_app.instance_path)
 
-    nzgd_id = int(record_name.split("_")[1])
+    nzgd_id = _nzgd_id(record_name)
 
-    with sqlite3.connect(instance_path / constants.database_file_name) as conn:
+    with query_sqlite_db.get_conn(instance_path / constants.database_file_name) as conn:
         cpt_measurements_df = query_sqlite_db.cpt_measurements_for_one_nzgd(
             nzgd_id, conn
         )
         vs30s_df = query_sqlite_db.cpt_vs30s_for_one_nzgd_id(nzgd_id, conn)
 
     type_prefix_to_folder = {"CPT": "cpt", "SCPT": "scpt", "BH": "borehole"}
+    # The record's metadata is the same in every row, so it is taken from the first row once
+    record = vs30s_df.iloc[0]
+
     path_to_files = (
-        Path(type_prefix_to_folder[vs30s_df["type_prefix"][0]])
-        / vs30s_df["region"][0]
-        / vs30s_df["district"][0]
-        / vs30s_df["city"][0]
-        / vs30s_df["suburb"][0]
-        / vs30s_df["record_name"][0]
+        Path(type_prefix_to_folder[record["type_prefix"]])
+        / record["region"]
+        / record["district"]
+        / record["city"]
+        / record["suburb"]
+        / record["record_name"]
     )
     url_str = constants.source_files_base_url + str(path_to_files)
-    vs30s_df["estimate_number"] = np.arange(1, len(vs30s_df) + 1)
-
-    tip_net_area_ratio = vs30s_df["cpt_tip_net_area_ratio"][0]
-    if tip_net_area_ratio is None:
-        tip_net_area_ratio = "Not available"
-    elif isinstance(tip_net_area_ratio, float):
-        tip_net_area_ratio = f"{tip_net_area_ratio:.2f}"
-
-    measured_gwl = vs30s_df["measured_gwl"][0]
-    if measured_gwl is None:
-        measured_gwl = "Not available"
-    elif isinstance(measured_gwl, float):
-        measured_gwl = f"{measured_gwl:.2f}"
-
-    model_gwl_westerhoff_2019 = vs30s_df["model_gwl_westerhoff_2019"][0]
-    if model_gwl_westerhoff_2019 is None:
-        model_gwl_westerhoff_2019 = "Not available"
-    elif isinstance(model_gwl_westerhoff_2019, float):
-        model_gwl_westerhoff_2019 = f"{model_gwl_westerhoff_2019:.2f}"
-
-    model_vs30_foster_2019 = vs30s_df["model_vs30_foster_2019"][0]
-    if model_vs30_foster_2019 is None:
-        model_vs30_foster_2019 = "Not available"
-    elif isinstance(model_vs30_foster_2019, float):
-        model_vs30_foster_2019 = f"{model_vs30_foster_2019:.2f}"
-
-    model_vs30_stddev_foster_2019 = vs30s_df["model_vs30_stddev_foster_2019"][0]
-    if model_vs30_stddev_foster_2019 is None:
-        model_vs30_stddev_foster_2019 = "Not available"
-    elif isinstance(model_vs30_stddev_foster_2019, float):
-        model_vs30_stddev_foster_2019 = f"{model_vs30_stddev_foster_2019:.2f}"
-
-    type_prefix = vs30s_df["type_prefix"][0]
-    if type_prefix is None:
-        type_prefix = "Not available"
-    elif isinstance(type_prefix, str):
-        type_prefix = f"{type_prefix}"
+    vs30s_df["estimate_number"] = np.arange(1, len(vs30s_df) + 1, dtype=np.int32)
+
+    tip_net_area_ratio = _fmt(record["cpt_tip_net_area_ratio"])
+
+    measured_gwl = _fmt(record["measured_gwl"])
+
+    model_gwl_westerhoff_2019 = _fmt(record["model_gwl_westerhoff_2019"])
+
+    model_vs30_foster_2019 = _fmt(record["model_vs30_foster_2019"])
+
+    model_vs30_stddev_foster_2019 = _fmt(record["model_vs30_stddev_foster_2019"])
+
+    type_prefix = _fmt(record["type_prefix"])
 
     ## Only show Vs30 values for correlations that could be used given the depth of the record
-    max_depth_for_record = vs30s_df["deepest_depth"].unique()[0]
+    max_depth_for_record = record["deepest_depth"]
 
     if max_depth_for_record < 5:
         vs30_correlation_explanation_text = (
@@ -477,21 +644,22 @@ def cpt_record(record_name: str):
         )
         show_vs30_values = True
 
-    # Plot the CPT data as a subplot with 1 row and 3 columns
+    # Plot the CPT data as a subplot with 1 row and 3 columns. The traces are drawn with WebGL
+    # (Scattergl), as a CPT can have thousands of measurements, which are slow to draw as SVG.
     fig = make_subplots(rows=1, cols=3)
 
     fig.add_trace(
-        go.Scatter(x=cpt_measurements_df["qc"], y=cpt_measurements_df["depth"]),
+        go.Scattergl(x=cpt_measurements_df["qc"], y=cpt_measurements_df["depth"]),
         row=1,
         col=1,
     )
     fig.add_trace(
-        go.Scatter(x=cpt_measurements_df["fs"], y=cpt_measurements_df["depth"]),
+        go.Scattergl(x=cpt_measurements_df["fs"], y=cpt_measurements_df["depth"]),
         row=1,
         col=2,
     )
     fig.add_trace(
-        go.Scatter(x=cpt_measurements_df["u2"], y=cpt_measurements_df["depth"]),
+        go.Scattergl(x=cpt_measurements_df["u2"], y=cpt_measurements_df["depth"]),
         row=1,
         col=3,
     )
@@ -508,10 +676,14 @@ def cpt_record(record_name: str):
 
     return flask.render_template(
         "views/cpt_record.html",
-        record_details=vs30s_df.to_dict(
+        # Pass the columns used by the template as a list of dictionaries
+        record_details=vs30s_df[constants.cpt_record_details_columns].to_dict(
             orient="records"
-        ),  # Pass DataFrame as list of dictionaries
-        cpt_plot=fig.to_html(),
+        ),
+        cpt_plot=fig.to_html(
+            full_html=False,  # Embed only the necessary plot HTML
+            include_plotlyjs=False,  # Plotly.js is loaded by base.html
+        ),
         vs30_correlation_explanation_text=vs30_correlation_explanation_text,
         show_vs30_values=show_vs30_values,
         url_str=url_str,
@@ -534,103 +706,106 @@ def remove_file(file_path):
         print(f"Error: {file_path} : {e.strerror}")
 
 
+def _csv_response(
+    df: pd.DataFrame, columns: list[str], header: list[str], filename: str
+) -> flask.Response:
+    """
+    Stream columns of a DataFrame as a downloadable CSV file.
+
+    The rows are written to CSV in chunks as the response is sent, rather than writing the
+    whole file to an in-memory buffer first.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The data to download.
+    columns : list[str]
+        The columns of df to write.
+    header : list[str]
+        The names to write in the header row for each of the columns.
+    filename : str
+        The name of the downloaded file.
+
+    Returns
+    -------
+    flask.Response
+        The streamed CSV response.
+    """
+
+    def generate_csv() -> Iterator[str]:
+        """Yield the header row and then the CSV rows in chunks."""
+        yield df.iloc[:0].to_csv(columns=columns, header=header, index=False)
+        for start in range(0, len(df), _csv_chunk_size):
+            yield df.iloc[start : start + _csv_chunk_size].to_csv(
+                columns=columns, header=False, index=False
+            )
+
+    return flask.Response(
+        generate_csv(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
 @bp.route("/download_cpt_data/<filename>")
 def download_cpt_data(filename):
-    """Serve a file from the instance path for download and delete it afterwards."""
+    """Serve CPT data as a downloadable CSV file."""
     instance_path = Path(flask.current_app.instance_path)
 
-    nzgd_id = int(filename.split("_")[1])
-    with sqlite3.connect(instance_path / constants.database_file_name) as conn:
+    nzgd_id = _nzgd_id(filename)
+    with query_sqlite_db.get_conn(instance_path / constants.database_file_name) as conn:
         cpt_measurements_df = query_sqlite_db.cpt_measurements_for_one_nzgd(
             nzgd_id, conn
         )
 
-    cpt_measurements_df.rename(
-        columns={
-            "depth": "depth_(m)",
-            "qc": "cone_resistance_qc_(Mpa)",
-            "fs": "sleeve_friction_fs_(Mpa)",
-            "u2": "pore_pressure_u2_(Mpa)",
-        },
-        inplace=True,
-    )
-
-    # Create a temporary CSV file containing the CPT data
-    download_buffer = StringIO()
-
-    cpt_measurements_df[
-        [
+    return _csv_response(
+        cpt_measurements_df,
+        columns=["depth", "qc", "fs", "u2"],
+        header=[
             "depth_(m)",
             "cone_resistance_qc_(Mpa)",
             "sleeve_friction_fs_(Mpa)",
             "pore_pressure_u2_(Mpa)",
-        ]
-    ].to_csv(download_buffer, index=False)
-    response = flask.make_response(download_buffer.getvalue())
-    response.mimetype = "text/csv"
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-
-    return response
+        ],
+        filename=filename,
+    )
 
 
 @bp.route("/download_spt_data/<filename>")
 def download_spt_data(filename):
-    """Serve SPT data as a downloadable CSV file using an in-memory buffer."""
+    """Serve SPT data as a downloadable CSV file."""
     instance_path = Path(flask.current_app.instance_path)
 
-    nzgd_id = int(filename.split("_")[1])
-    with sqlite3.connect(instance_path / constants.database_file_name) as conn:
+    nzgd_id = _nzgd_id(filename)
+    with query_sqlite_db.get_conn(instance_path / constants.database_file_name) as conn:
         spt_measurements_df = query_sqlite_db.spt_measurements_for_one_nzgd(
             nzgd_id, conn
         )
 
-    # Create a buffer for the CSV data
-    download_buffer = StringIO()
-
-    # Rename columns and write to buffer
-    spt_measurements_df.rename(
-        columns={"depth": "depth_m", "n": "number_of_blows"}, inplace=True
-    )
-    spt_measurements_df[["depth_m", "number_of_blows"]].to_csv(
-        download_buffer, index=False
+    return _csv_response(
+        spt_measurements_df,
+        columns=["depth", "n"],
+        header=["depth_m", "number_of_blows"],
+        filename=filename,
     )
 
-    # Create response directly from the buffer
-    response = flask.make_response(download_buffer.getvalue())
-    response.mimetype = "text/csv"
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-
-    return response
-
 
 @bp.route("/download_spt_soil_types/<filename>")
 def download_spt_soil_types(filename):
-    """Serve SPT soil types as a downloadable CSV file using an in-memory buffer."""
+    """Serve SPT soil types as a downloadable CSV file."""
     instance_path = Path(flask.current_app.instance_path)
 
-    nzgd_id = int(filename.split("_")[1])
-    with sqlite3.connect(instance_path / constants.database_file_name) as conn:
+    nzgd_id = _nzgd_id(filename)
+    with query_sqlite_db.get_conn(instance_path / constants.database_file_name) as conn:
         spt_soil_types_df = query_sqlite_db.spt_soil_types_for_one_nzgd(nzgd_id, conn)
 
-    spt_soil_types_df.rename(
-        columns={"top_depth": "depth_at_layer_top_m"}, inplace=True
+    return _csv_response(
+        spt_soil_types_df,
+        columns=["top_depth", "soil_type"],
+        header=["depth_at_layer_top_m", "soil_type"],
+        filename=filename,
     )
 
-    # Create a buffer for the CSV data
-    download_buffer = StringIO()
-
-    # Write the data to the buffer
-    spt_soil_types_df[["depth_at_layer_top_m", "soil_type"]].to_csv(
-        download_buffer, index=False
-    )
-
-    # Create response directly from the buffer
-    response = flask.make_response(download_buffer.getvalue())
-    response.mimetype = "text/csv"
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-
-    return response
-
 
 @bp.route("/validate", methods=["GET"])
 def validate():
@@ -641,44 +816,31 @@ def validate():
     if not query:
         return ""
 
-    # Create a dummy dataframe to ensure the column names are present
-    dummy_df = pd.DataFrame(
-        columns=[
-            "cpt_id",
-            "nzgd_id",
-            "vs30",
-            "vs30_stddev",
-            "type_prefix",
-            "original_reference",
-            "investigation_date",
-            "published_date",
-            "latitude",
-            "longitude",
-            "model_vs30_foster_2019",
-            "model_vs30_stddev_foster_2019",
-            "model_gwl_westerhoff_2019",
-            "cpt_tip_net_area_ratio",
-            "measured_gwl",
-            "deepest_depth",
-            "shallowest_depth",
-            "region",
-            "district",
-            "suburb",
-            "city",
-            "record_name",
-            "vs30_log_residual",
-            "gwl_residual",
-            "spt_efficiency",
-            "spt_borehole_diameter",
-        ]
-    )
+    error = _query_error(query)
+    if error is None:
+        return ""
+    return flask.render_template("error.html", error=error)
+
+
+@functools.lru_cache(maxsize=512)
+def _query_error(query: str) -> str | None:
+    """
+    Find the error (if any) from running a query on the dummy DataFrame.
+
+    The result is cached, as the same query strings are validated repeatedly while typing.
+
+    Parameters
+    ----------
+    query : str
+        The query string to validate.
+
+    Returns
+    -------
+    str or None
+        The error message if the query is invalid, or None if it is valid.
+    """
     try:
-        dummy_df.query(query)
-    except (
-        ValueError,
-        SyntaxError,
-        UnboundLocalError,
-        pd.errors.UndefinedVariableError,
-    ) as e:
-        return flask.render_template("error.html", error=e)
-    return ""
+        _validation_df.query(query)
+    except _query_exceptions as e:
+        return str(e)
+    return None